@@ -5,15 +5,17 @@ Date: Spring 2020
 Website: github.com/keyan3
 """
 
-from collections import defaultdict
-from typing import List, Set
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_all_start_methods, get_context
+from typing import List
 import os
 
+import numpy as np
 import pandas as pd
 from utils import (
-    clean_phone, add_slug, gen_company_mapping, get_last_appearance_field_value, add_license_field, get_csvs_in_dir,
-    convert_str_to_datetime_maker, get_license_df, get_index_of_date, append_tag_conditional, get_slugs_up_to_i_array,
-    get_column_difference
+    clean_phone, add_slug, get_storefronts, gen_company_mapping, get_last_appearance_field_value,
+    update_last_appearances, add_license_field, get_csvs_in_dir, get_csv_filenames, get_license_df, get_index_of_date,
+    get_slug_dtype, get_slug_codes, get_slug_presence, get_presence_after_i, get_column_difference
 )
 
 TAG_CHANGE_FIELDS = ['address', 'dispensary_name', 'email']
@@ -28,14 +30,15 @@ def clean_files(files: List[pd.DataFrame]) -> List[pd.DataFrame]:
     Clean phone and dispensary name, and add slug
     Tags: slug
     """
-    for i in range(file_count):
-        files[i] = add_slug(files[i])
-        if 'phone' in files[i].columns:
-            files[i] = clean_phone(files[i])
-        if 'dispensary_name' in files[i].columns:
-            files[i]['dispensary_name'] = files[i]['dispensary_name'].str.lower()
-            files[i]['dispensary_name'] = files[i]['dispensary_name'].str.strip()
-    return files
+    cleaned_files = []
+    for file in files:
+        file = add_slug(file)
+        if 'phone' in file.columns:
+            file = clean_phone(file)
+        if 'dispensary_name' in file.columns:
+            file['dispensary_name'] = file['dispensary_name'].str.lower().str.strip()
+        cleaned_files.append(file)
+    return cleaned_files
 
 
 def add_license_info() -> None:
@@ -64,32 +67,24 @@ def tag_license_status() -> None:
     for i in range(file_count):
         if 'license' in files[i].columns:
             file = files[i]
+            issue_dt = pd.to_datetime(file['issue_date'], format='%m/%d/%Y', errors='coerce', cache=True)
+            access_dt = pd.to_datetime(file['access_date'], format='%Y-%m-%d', errors='coerce', cache=True)
+
+            license_notnull = file['license'].notnull().to_numpy()
+            issue_notnull = issue_dt.notna().to_numpy()
+            le_mask = (issue_dt <= access_dt).to_numpy()
+            gt_mask = (issue_dt > access_dt).to_numpy()
+
             for license_status in ['active', 'canceled', 'expired', 'revoked', 'suspended']:
                 tag_name = license_status + '_license'
                 if license_status in file['status'].unique():
-                    file[tag_name] = (
-                        file['license'].notnull() &
-                        file['issue_date'].notnull() &
-                        (
-                            file['issue_date'].apply(convert_str_to_datetime_maker('%m/%d/%Y'))
-                            <= file['access_date'].apply(convert_str_to_datetime_maker('%Y-%m-%d'))
-                        ) &
-                        file['status'].str.contains(license_status)
-                    ).apply(int)
-
-            file['possible_license'] = (
-                file['license'].notnull() &
-                file['issue_date'].isna()
-            ).apply(int)
-
-            file['future_license_explicit'] = (
-                file['license'].notnull() &
-                file['issue_date'].notnull() &
-                (
-                    file['issue_date'].apply(convert_str_to_datetime_maker('%m/%d/%Y'))
-                    > file['access_date'].apply(convert_str_to_datetime_maker('%Y-%m-%d'))
-                )
-            ).apply(int)
+                    status_contains = file['status'].str.contains(license_status, na=False).to_numpy()
+                    file[tag_name] = (license_notnull & issue_notnull & le_mask & status_contains).astype(np.int8)
+
+            # unmatched licenses have no registry issue date at all; an unparseable date still counts as a match
+            file['possible_license'] = (license_notnull & file['issue_date'].isna().to_numpy()).astype(np.int8)
+
+            file['future_license_explicit'] = (license_notnull & issue_notnull & gt_mask).astype(np.int8)
 
 
 def tag_assumed_license_status() -> None:
@@ -100,27 +95,17 @@ def tag_assumed_license_status() -> None:
 
     Tags: assumed_license
     """
-    active_license_slugs_after_i = [set()]
-    for i in reversed(range(0, file_count - 1)):
-        file_after_i = files[i + 1]
-        if 'license' in file_after_i.columns:
-            file_after_i_active_slugs = set(file_after_i['slug'][file_after_i['active_license'] == 1])
-            active_license_slugs_after_i.insert(0, file_after_i_active_slugs.union(active_license_slugs_after_i[0]))
-        else:
-            active_license_slugs_after_i.insert(0, active_license_slugs_after_i[0])
-
-    active_license_slugs_at_i = (
-        list(map(
-            lambda x: set(x['slug'][x['active_license'] == 1]) if 'license' in x.columns else {},
-            files
-        ))
-    )
+    active_license_presence = np.zeros_like(slug_presence)
+    for i in range(file_count):
+        if 'license' in files[i].columns:
+            active_license_presence[i, slug_codes[i][files[i]['active_license'].to_numpy() == 1]] = True
+    active_license_after_i = get_presence_after_i(active_license_presence)
 
     for i in range(file_count):
+        codes = slug_codes[i]
         files[i]['assumed_license'] = (
-            files[i]['slug'].isin(active_license_slugs_after_i[i]) &
-            ~files[i]['slug'].isin(active_license_slugs_at_i[i])
-        ).apply(int)
+            active_license_after_i[i][codes] & ~active_license_presence[i][codes]
+        ).astype(np.int8)
 
 
 def tag_field_changes() -> None:
@@ -131,28 +116,23 @@ def tag_field_changes() -> None:
     for i in range(1, file_count):
         curr_file = files[i]
         prev_file = files[i - 1]
+
+        # row of each continued storefront in the previous panel, looked up by slug code
+        continued = curr_file['continued'].to_numpy() == 1
+        prev_row_by_code = np.zeros(slug_count, dtype=np.int64)
+        prev_row_by_code[slug_codes[i - 1]] = np.arange(len(prev_file))
+        prev_rows = prev_row_by_code[slug_codes[i][continued]]
+
         for field in TAG_CHANGE_FIELDS:
             if (field not in files[i].columns) or (field not in files[i - 1].columns):
                 break
 
-            prev_field, curr_field = prev_file[field], curr_file[field]
-            prev_slug_column, curr_slug_column = prev_file['slug'], curr_file['slug']
-            continued = curr_file['continued']
-
-            prev_slug_to_prev_field_value = defaultdict(lambda: None)
-            for j in range(len(prev_file)):
-                prev_slug = prev_slug_column.iloc[j]
-                prev_slug_to_prev_field_value[prev_slug] = prev_field.iloc[j]
-
-            changed_field = []
-            for j in range(len(curr_file)):
-                prev_field_value = prev_slug_to_prev_field_value[curr_slug_column.iloc[j]]
-                curr_field_value = curr_field.iloc[j]
-                append_tag_conditional(changed_field, continued.iloc[j] == 1 and prev_field_value != curr_field_value)
+            changed_field = np.zeros(len(curr_file), dtype=np.int8)
+            changed_field[continued] = prev_file[field].to_numpy()[prev_rows] != curr_file[field].to_numpy()[continued]
             curr_file['changed_' + field] = changed_field
 
 
-def tag_reappear_field_changes(slugs_at_i: List[Set[str]]) -> None:
+def tag_reappear_field_changes() -> None:
     """
     For each of the fields in TAG_CHANGE_FIELDS, tag storefronts that disappeared and reappeared in a later wave with
     the field changed (could be anywhere from 2 to 9 panels apart). Overwrites previous tags from tag_field_changes,
@@ -160,7 +140,12 @@ def tag_reappear_field_changes(slugs_at_i: List[Set[str]]) -> None:
 
     Tags: [changed_{column} for column in TAG_CHANGE_FIELDS] (e.g. changed address)
     """
+    last_appearances = {}
+    update_last_appearances(last_appearances, files[0], 0)
     for i in range(2, file_count):
+        # reappeared storefronts are absent from wave i - 1, so their latest appearance up to i - 1 is also their
+        # latest appearance up to i - 2
+        update_last_appearances(last_appearances, files[i - 1], i - 1)
         curr_file = files[i]
         for field in TAG_CHANGE_FIELDS:
             if not all([field in file.columns for file in files[0: i + 1]]):
@@ -170,15 +155,14 @@ def tag_reappear_field_changes(slugs_at_i: List[Set[str]]) -> None:
             curr_slug_column = curr_file['slug']
             old_changed_column = curr_file['changed_' + field]
 
-            changed_field = []
-            for j in range(len(curr_file)):
-                if reappeared.iloc[j] == 1:
-                    prev_field_value = get_last_appearance_field_value(slug=curr_slug_column.iloc[j], max_wave=i-2,
-                                                                       field=field, slugs_at_i=slugs_at_i, files=files)
-                    curr_field_value = curr_field.iloc[j]
-                    append_tag_conditional(changed_field, prev_field_value != curr_field_value)
-                else:
-                    changed_field.append(old_changed_column.iloc[j])
+            reappeared_mask = reappeared.to_numpy() == 1
+            prev_field_values = np.array([
+                get_last_appearance_field_value(slug=slug, field=field, last_appearances=last_appearances, files=files)
+                for slug in curr_slug_column.to_numpy()[reappeared_mask]
+            ], dtype=object)
+
+            changed_field = old_changed_column.to_numpy().copy()
+            changed_field[reappeared_mask] = prev_field_values != curr_field.to_numpy()[reappeared_mask]
             curr_file['changed_' + field] = changed_field
 
 
@@ -188,10 +172,7 @@ def tag_continued() -> None:
     Tags: continued
     """
     for i in range(1, file_count):
-        curr_file = files[i]
-        prev_file = files[i - 1]
-        prev_slug_set = set(prev_file['slug'])
-        curr_file['continued'] = files[i]['slug'].isin(prev_slug_set).apply(int)
+        files[i]['continued'] = slug_presence[i - 1][slug_codes[i]].astype(np.int8)
 
 
 def tag_disappear() -> None:
@@ -200,26 +181,22 @@ def tag_disappear() -> None:
     Tags: disappeared
     """
     for i in range(0, file_count - 1):
-        curr_file = files[i]
-        next_file = files[i + 1]
-        next_slug_set = set(next_file['slug'])
-        curr_file['disappeared'] = (~files[i]['slug'].isin(next_slug_set)).apply(int)
+        files[i]['disappeared'] = (~slug_presence[i + 1][slug_codes[i]]).astype(np.int8)
 
 
-def tag_reappear(slugs_up_to_i: List[Set[str]]) -> None:
+def tag_reappear() -> None:
     """
     Add a reappear column for storefronts which reappear in a given wave after disappearing
     Tags: reappear
     """
+    slug_mask_up_to_i = np.zeros(slug_count, dtype=bool)
     for i in range(2, file_count):
-        curr_file = files[i]
-        prev_file = files[i - 1]
-        prev_slug_set = set(prev_file['slug'])
-        curr_file['reappeared'] = (files[i]['slug'].isin(slugs_up_to_i[i - 2]) &
-                                   ~files[i]['slug'].isin(prev_slug_set)).apply(int)
+        slug_mask_up_to_i |= slug_presence[i - 2]
+        codes = slug_codes[i]
+        files[i]['reappeared'] = (slug_mask_up_to_i[codes] & ~slug_presence[i - 1][codes]).astype(np.int8)
 
 
-def tag_illegal_storefronts(slugs_at_i: List[Set[str]], slugs_up_to_i: List[Set[str]]) -> None:
+def tag_illegal_storefronts() -> None:
     """
     Weedmaps purged many illegal storefronts between 12/15/19 and 01/12/20; we create two tags to capture this.
     First, we tag storefronts present on 12/15/19 but not present on 01/12/20 as 'illegal_1912', and storefronts
@@ -233,14 +210,16 @@ def tag_illegal_storefronts(slugs_at_i: List[Set[str]], slugs_up_to_i: List[Set[
 
     index_191221 = get_index_of_date('191221', filenames)
     index_200112 = get_index_of_date('200112', filenames)
-    in_191221_not_200112 = slugs_at_i[index_191221].difference(slugs_at_i[index_200112])
-    before_191221_not_200112 = slugs_up_to_i[index_191221 - 1].difference(slugs_at_i[index_200112])
-    before_191221_not_200112_or_191221 = before_191221_not_200112.difference(slugs_at_i[index_191221])
+    in_191221 = slug_presence[index_191221]
+    in_200112 = slug_presence[index_200112]
+    before_191221 = np.logical_or.reduce(slug_presence[:index_191221], axis=0)
+    in_191221_not_200112 = in_191221 & ~in_200112
+    before_191221_not_200112_or_191221 = before_191221 & ~in_200112 & ~in_191221
 
     for i in range(file_count):
         if '200112' not in filenames[i]:
-            files[i]['illegal_1912'] = files[i]['slug'].isin(in_191221_not_200112).apply(int)
-            files[i]['illegal_other'] = files[i]['slug'].isin(before_191221_not_200112_or_191221).apply(int)
+            files[i]['illegal_1912'] = in_191221_not_200112[slug_codes[i]].astype(np.int8)
+            files[i]['illegal_other'] = before_191221_not_200112_or_191221[slug_codes[i]].astype(np.int8)
 
 
 def tag_dispensary_or_delivery() -> None:
@@ -249,8 +228,9 @@ def tag_dispensary_or_delivery() -> None:
     Tags: is_dispensary, is_delivery
     """
     for i in range(file_count):
-        files[i]['is_dispensary'] = files[i]['url'].str.contains("weedmaps.com/dispensaries/").apply(int)
-        files[i]['is_delivery'] = files[i]['url'].str.contains("weedmaps.com/deliveries/").apply(int)
+        storefront_type = files[i]['url'].str.extract(r'weedmaps\.com/(dispensaries|deliveries)/', expand=False)
+        files[i]['is_dispensary'] = (storefront_type == 'dispensaries').astype(np.int8)
+        files[i]['is_delivery'] = (storefront_type == 'deliveries').astype(np.int8)
 
 
 def standardize_files(full_files: List[pd.DataFrame]) -> List[str]:
@@ -264,31 +244,54 @@ def standardize_files(full_files: List[pd.DataFrame]) -> List[str]:
             max_tag_num = len(file_tags)
             max_file_tag_set = file_tags
 
+    # Missing tags are added as one block of NaN columns, which are written as empty fields
     for i in range(file_count):
-        for field in max_file_tag_set:
-            if field not in files[i].columns:
-                files[i][field] = [''] * len(files[i])
+        missing_tags = [field for field in max_file_tag_set if field not in files[i].columns]
+        if missing_tags:
+            empty_tags = pd.DataFrame(np.full((len(files[i]), len(missing_tags)), np.nan, dtype=np.float32),
+                                      columns=missing_tags, index=files[i].index)
+            files[i] = pd.concat([files[i], empty_tags], axis=1)
 
     return max_file_tag_set
 
 
+def write_outputs(i: int) -> None:
+    """
+    Add tags to the i-th original, product-containing file and write it and its company mapping to the output
+    directories
+    """
+    tagged_file = pd.merge(full_files[i], files[i][['slug'] + tag_list], on='slug', copy=False)
+    tagged_file.to_csv('output/panel/' + filenames[i][:6] + '_tagged.csv', line_terminator='\n')
+    gen_company_mapping(tagged_file, 'output/company/' + filenames[i][:6] + '_company_mapping.csv')
+
+
 def main() -> None:
-    global files, filenames, file_count
+    global files, full_files, filenames, file_count, slug_codes, slug_count, slug_presence, tag_list
     full_files, filenames = get_csvs_in_dir(PANEL_INPUT_DIR, return_filenames=True)
     file_count = len(full_files)
 
     for file in full_files:
         assert 'url' in file.columns, 'Panel files must include url field'
 
-    # Group files by slug to remove unneeded product info (shrinks files to ~2% of full size)
+    # Reduce files to one row per slug to remove unneeded product info (shrinks files to ~2% of full size)
     full_files = clean_files(full_files)
-    files = [file.groupby('slug').agg('first').reset_index() for file in full_files]
+    slug_dtype = get_slug_dtype(full_files)
+    for file in full_files:
+        file['slug'] = file['slug'].astype(slug_dtype)
+    files = [get_storefronts(file) for file in full_files]
 
-    if (
-            os.path.exists(LICENSE_INPUT_DIR) and len(get_csvs_in_dir(LICENSE_INPUT_DIR)) > 0
-            and os.path.exists(DISP_SCRAPE_INPUT_DIR) and len(get_csvs_in_dir(DISP_SCRAPE_INPUT_DIR)) > 0
-    ):
+    has_license_info = (
+            os.path.exists(LICENSE_INPUT_DIR) and len(get_csv_filenames(LICENSE_INPUT_DIR)) > 0
+            and os.path.exists(DISP_SCRAPE_INPUT_DIR) and len(get_csv_filenames(DISP_SCRAPE_INPUT_DIR)) > 0
+    )
+    if has_license_info:
         add_license_info()
+
+    # Integer codes of the shared slug dtype, used for storefront membership checks between waves
+    slug_codes, slug_count = get_slug_codes(files)
+    slug_presence = get_slug_presence(slug_codes, slug_count)
+
+    if has_license_info:
         tag_license_status()
         tag_assumed_license_status()
 
@@ -298,31 +301,26 @@ def main() -> None:
 
     tag_disappear()
 
-    slugs_up_to_i = get_slugs_up_to_i_array(files)
-    slugs_at_i = list(map(lambda x: set(x['slug']), files))
+    tag_reappear()
 
-    tag_reappear(slugs_up_to_i)
+    tag_reappear_field_changes()
 
-    tag_reappear_field_changes(slugs_at_i)
-
-    tag_illegal_storefronts(slugs_at_i, slugs_up_to_i)
+    tag_illegal_storefronts()
 
     tag_dispensary_or_delivery()
 
     tag_list = standardize_files(full_files)
 
-    # Add tags to original, product-containing files
-    for i in range(file_count):
-        tags_only_file = files[i][['slug'] + tag_list]
-        files[i] = pd.merge(full_files[i], tags_only_file, on='slug')
-
-    # Write tagged panels to output directory
-    for i in range(file_count):
-        files[i].to_csv('output/panel/' + filenames[i][:6] + '_tagged.csv', line_terminator='\n')
-
-    # Write company mappings to output directory
-    for i in range(file_count):
-        gen_company_mapping(files[i], 'output/company/' + filenames[i][:6] + '_company_mapping.csv')
+    # Add tags to original, product-containing files and write them and their company mappings to output directory,
+    # one panel per process. Forked workers inherit the module state, so only the panel index is sent to each worker.
+    # Platforms without fork (e.g. Windows) write the panels serially instead.
+    if 'fork' in get_all_start_methods():
+        with ProcessPoolExecutor(max_workers=min(file_count, os.cpu_count()),
+                                 mp_context=get_context('fork')) as executor:
+            list(executor.map(write_outputs, range(file_count)))
+    else:
+        for i in range(file_count):
+            write_outputs(i)
 
 
 if __name__ == "__main__":
@@ -6,28 +6,25 @@ Website: github.com/keyan3
 """
 
 from collections import defaultdict
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import os
-from typing import List, Set, Tuple, Callable, Union, Any
+import re
+from typing import Dict, List, Tuple, Union, Any
 import uuid
 
-from disjoint_set import DisjointSet
+from numba import njit
 import numpy as np
 import pandas as pd
+from pandas.api.types import CategoricalDtype
 import stringcase
 
 LICENSE_FIELDS = ['License Number', 'License Type', 'Status', 'Status Date', 'Issue Date', 'Adult-Use/Medicinal']
 
+CSV_CACHE_DIR = '.cache'
+MAX_READ_THREADS = 8
 
-def country_code(n: str) -> str:
-    """
-    Helper function to add country code to a phone number if it does not have one already.
-    NOTE: area codes in North America cannot start with a 0 or 1
-    """
-    if n[0] != '1':
-        return '1' + n
-    else:
-        return n
+PHONE_START_PATTERN = re.compile(r'^[0-9(]')
+NON_DIGIT_PATTERN = re.compile(r'[^0-9]')
 
 
 def clean_phone(df: pd.DataFrame) -> pd.DataFrame:
@@ -36,29 +33,47 @@ def clean_phone(df: pd.DataFrame) -> pd.DataFrame:
         1. Removing all numbers that do not start with a parenthesis or digit
         2. Removing all non-digit characters
         3. Standardizing to 1########## format
+    NOTE: area codes in North America cannot start with a 0 or 1, so a leading 1 is taken to be the country code
     """
-    df_pclean = df[df['phone'].notnull()]
+    df_pclean = df[df['phone'].notnull()].copy()
     df_pclean['phone'] = df_pclean['phone'].astype(str)
-    df_pclean = df_pclean[df_pclean['phone'].str.contains('^([0-9]|\().*')]
 
-    df_pclean['stdrd_phone'] = df_pclean['phone'].str.replace("[^0-9]", "")
-    df_pclean = df_pclean[df_pclean['stdrd_phone'].apply(len) > 0]
-    df_pclean['stdrd_phone'] = df_pclean['stdrd_phone'].apply(country_code)
-    df_pclean['stdrd_phone'] = df_pclean['stdrd_phone'].str[:11]
+    digits = df_pclean['phone'].str.replace(NON_DIGIT_PATTERN, '', regex=True)
+    digits = pd.Series(np.where(digits.str[:1] == '1', digits, '1' + digits), index=digits.index)
+    df_pclean['stdrd_phone'] = digits.str[:11]
 
-    df_pclean = df_pclean[df_pclean['stdrd_phone'].str.contains('^.{11}$')]
-    df_pclean = df_pclean[df_pclean['stdrd_phone'].str.contains('^((?!000000).)*$')]
-    return df_pclean
+    valid = (
+        df_pclean['phone'].str.match(PHONE_START_PATTERN) &
+        (df_pclean['stdrd_phone'].str.len() == 11) &
+        ~df_pclean['stdrd_phone'].str.contains('000000', regex=False)
+    )
+    return df_pclean[valid]
 
 
 def add_slug(df: pd.DataFrame) -> pd.DataFrame:
-    df = df[df['url'].notnull()]
-    df = df[df['url'].apply(type) == str]
-    df = df[df['url'].str.contains('.*/.*')]
-    df['slug'] = df['url'].apply(lambda x: x.split('/')[-1])
+    # .str methods return NaN for missing and non-string urls, so na=False drops them along with urls without a slash
+    df = df[df['url'].str.contains('/', regex=False, na=False)].copy()
+    df['slug'] = df['url'].str.rsplit('/', n=1).str[-1]
     return df
 
 
+def get_storefronts(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Reduces a product-level panel to one row per storefront, keeping the first non-null value of each column like
+    groupby('slug').agg('first'). The first row of each slug is kept as is, and only columns where that row has missing
+    values fall back to a groupby.
+    """
+    # Series.duplicated works on the categorical codes, whereas DataFrame.drop_duplicates re-factorizes the slugs
+    storefronts = df[~df['slug'].duplicated(keep='first')].set_index('slug')
+    null_columns = list(storefronts.columns[storefronts.isna().any()])
+    if len(null_columns) > 0:
+        # assign by position, since aligning on the categorical slug index is slow
+        first_values = df.groupby('slug', observed=True)[null_columns].agg('first').reindex(storefronts.index)
+        for column in null_columns:
+            storefronts[column] = first_values[column].to_numpy()
+    return storefronts.reset_index()
+
+
 def gen_company_mapping(df: pd.DataFrame, path: str) -> None:
     """
     Function generates storefront-company mapping by:
@@ -68,7 +83,7 @@ def gen_company_mapping(df: pd.DataFrame, path: str) -> None:
         4. Generating a UUID for each company
         5. Adding these UUIDs to the panel dataframe (grouped by storefront ID)
         6. Dropping all columns beside storefront and company ID
-    A union-find data structure is used to keep track of the company assignments
+    A union-find data structure over integer storefront codes is used to keep track of the company assignments
     throughout the function.
     """
     # drop unneeded columns
@@ -77,81 +92,106 @@ def gen_company_mapping(df: pd.DataFrame, path: str) -> None:
     else:
         df_sim = df[['email', 'slug', 'product_name']]
 
-    # groupby name and agg columns appropriately for company grouping
+    # groupby name and agg columns appropriately for company grouping (observed=True skips slugs of other panels)
     if 'phone' in df.columns:
-        df_sim_2 = df_sim.groupby('slug').agg(
+        df_sim_2 = df_sim.groupby('slug', observed=True).agg(
             {'email': 'first', 'phone': 'first', 'product_name': lambda x: frozenset(x)})
     else:
-        df_sim_2 = df_sim.groupby('slug').agg({'email': 'first', 'product_name': lambda x: frozenset(x)})
-    ds = DisjointSet()
+        df_sim_2 = df_sim.groupby('slug', observed=True).agg(
+            {'email': 'first', 'product_name': lambda x: frozenset(x)})
 
-    # add all storefront IDs to DJS
-    for sid in df_sim_2.index:
-        ds.find(sid)
-
-    # setup hash tables for later unions
+    # setup hash tables for later unions, keyed by value and holding integer storefront codes
     product_ht = defaultdict(lambda: [])
     email_ht = defaultdict(lambda: [])
     phone_ht = defaultdict(lambda: [])
 
-    for sid in df_sim_2.index:
-        row = df_sim_2.loc[sid]
-        if not row.isnull()['product_name']:
-            prod_set = row['product_name']
-        if not row.isnull()['email']:
-            email = row['email']
-        if 'phone' in df.columns:
-            if not row.isnull()['phone']:
-                phone = row['phone']
-            phone_ht[phone].append(sid)
-        product_ht[prod_set].append(sid)
-        email_ht[email].append(sid)
-
-    # union storefront IDs with same product offering
-    for key in product_ht:
-        first_sid = product_ht[key][0]
-        for curr_sid in product_ht[key][1:]:
-            ds.union(first_sid, curr_sid)
-
-    # union storefront IDs with same email (check NaN)
-    for key in email_ht:
-        first_sid = email_ht[key][0]
-        for curr_sid in email_ht[key][1:]:
-            ds.union(first_sid, curr_sid)
-
-    # union storefront IDs with same phone
+    # fill hash tables in one pass over the column arrays, skipping missing emails and phones (groupby 'first'
+    # returns None for a storefront whose values are all missing, so pd.notna is needed rather than a NaN check)
+    for code, (prod_set, email) in enumerate(zip(df_sim_2['product_name'].to_numpy(), df_sim_2['email'].to_numpy())):
+        product_ht[prod_set].append(code)
+        if pd.notna(email):
+            email_ht[email].append(code)
     if 'phone' in df.columns:
-        for key in phone_ht:
-            first_sid = phone_ht[key][0]
-            for curr_sid in phone_ht[key][1:]:
-                ds.union(first_sid, curr_sid)
+        for code, phone in enumerate(df_sim_2['phone'].to_numpy()):
+            if pd.notna(phone):
+                phone_ht[phone].append(code)
+
+    # union storefronts with same product offering, email, or phone
+    parent = np.arange(len(df_sim_2), dtype=np.int32)
+    rank = np.zeros_like(parent)
+    for ht in [product_ht, email_ht, phone_ht]:
+        for codes in ht.values():
+            if len(codes) > 1:
+                uf_union_group(parent, rank, np.asarray(codes, dtype=np.int32))
 
     # add company_id column to df
-    df_sim_2['company_id'] = np.zeros(df_sim_2.index.shape)
-
-    for comp in ds.itersets():
-        comp_id = str(uuid.uuid1())
-        for sid in comp:
-            df_sim_2.loc[sid, 'company_id'] = comp_id
+    roots = uf_find_all(parent)
+    unique_roots, company_index = np.unique(roots, return_inverse=True)
+    company_ids = np.array([str(uuid.uuid1()) for _ in range(len(unique_roots))], dtype=object)
+    df_sim_2['company_id'] = company_ids[company_index]
 
     mapping = df_sim_2[['company_id']]
 
     mapping.to_csv(path, line_terminator='\n')
 
 
-def get_last_appearance_field_value(slug: str, max_wave: int, field: str, slugs_at_i: List[Set[str]],
-                                    files: List[pd.DataFrame]) -> Any:
+@njit(cache=True)
+def uf_find(parent: np.ndarray, x: int) -> int:
     """
-    Finds the address, email, and name of that storefront at the latest time it appeared in waves 0 to max_wave
+    Union-find lookup with path halving
     """
-    for i in reversed(range(0, max_wave + 1)):
-        if slug in slugs_at_i[i]:
-            break
+    while parent[x] != x:
+        parent[x] = parent[parent[x]]
+        x = parent[x]
+    return x
+
+
+@njit(cache=True)
+def uf_union(parent: np.ndarray, rank: np.ndarray, a: int, b: int) -> None:
+    root_a, root_b = uf_find(parent, a), uf_find(parent, b)
+    if root_a == root_b:
+        return
+    if rank[root_a] < rank[root_b]:
+        parent[root_a] = root_b
+    elif rank[root_a] > rank[root_b]:
+        parent[root_b] = root_a
+    else:
+        parent[root_b] = root_a
+        rank[root_a] += 1
+
+
+@njit(cache=True)
+def uf_union_group(parent: np.ndarray, rank: np.ndarray, ids: np.ndarray) -> None:
+    first = ids[0]
+    for k in range(1, ids.shape[0]):
+        uf_union(parent, rank, first, ids[k])
 
-    last_slug_subset = files[i][files[i]['slug'] == slug]
-    last_appearance_field_value = last_slug_subset[field].iloc[0]
 
-    return last_appearance_field_value
+@njit(cache=True)
+def uf_find_all(parent: np.ndarray) -> np.ndarray:
+    roots = np.empty_like(parent)
+    for x in range(parent.shape[0]):
+        roots[x] = uf_find(parent, x)
+    return roots
+
+
+def update_last_appearances(last_appearances: Dict[str, Tuple[int, int]], file: pd.DataFrame, wave: int) -> None:
+    """
+    Records every storefront in the given wave as last appearing at (wave, row position). Calling this in ascending
+    wave order keeps last_appearances pointing at each storefront's latest appearance so far.
+    """
+    slugs = file['slug'].to_numpy()
+    last_appearances.update(zip(slugs, zip([wave] * len(slugs), range(len(slugs)))))
+
+
+def get_last_appearance_field_value(slug: str, field: str, last_appearances: Dict[str, Tuple[int, int]],
+                                    files: List[pd.DataFrame]) -> Any:
+    """
+    Finds the address, email, and name of that storefront at the latest time it appeared, using the (wave, row
+    position) index maintained by update_last_appearances
+    """
+    wave, row = last_appearances[slug]
+    return files[wave][field].iat[row]
 
 
 def add_license_field(path: str, files: List[pd.DataFrame], filenames: List[str]) -> None:
@@ -174,46 +214,73 @@ def add_license_field(path: str, files: List[pd.DataFrame], filenames: List[str]
     for i, date_str in enumerate(scrape_dates_with_licenses):
         for j, filename in enumerate(filenames):
             if date_str in filename:
-                matching_scrape = scrape_files_with_licenses[i][['slug', 'license']]
+                matching_scrape = scrape_files_with_licenses[i][['slug', 'license']].copy()
+                # match the panel's slug dtype so the merge joins on the shared categorical codes
+                matching_scrape['slug'] = matching_scrape['slug'].astype(files[j]['slug'].dtype)
                 files[j] = pd.merge(files[j], matching_scrape, on='slug')
 
 
-def get_csvs_in_dir(dir: str, return_filenames: bool = False,
-                    sort: bool = True) -> Union[List[pd.DataFrame], Tuple[List[pd.DataFrame], List[str]]]:
+def get_csv_filenames(dir: str, sort: bool = True) -> List[str]:
     filenames = os.listdir(dir)
-    if '.DS_Store' in filenames:
-        filenames.remove('.DS_Store')
+    for ignored in ['.DS_Store', CSV_CACHE_DIR]:
+        if ignored in filenames:
+            filenames.remove(ignored)
     if sort:
         filenames = sorted(filenames)
-    files = []
-    for filename in filenames:
-        files.append(pd.read_csv(dir + filename, lineterminator='\n'))
+    return filenames
+
+
+def read_csv_cached(dir: str, filename: str) -> pd.DataFrame:
+    """
+    Reads a CSV through a Parquet copy in dir/CSV_CACHE_DIR, which is (re)written whenever it is missing or older than
+    the CSV. Files with columns Parquet cannot store (e.g. mixed types), or whose cache cannot be written, are always
+    read from the CSV.
+    """
+    csv_path = dir + filename
+    cache_path = os.path.join(dir, CSV_CACHE_DIR, filename + '.parquet')
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(csv_path):
+        df = pd.read_parquet(cache_path)
+        # Parquet restores missing strings as None, whereas read_csv (and the tagging code) uses NaN
+        object_columns = df.select_dtypes(include='object').columns
+        df[object_columns] = df[object_columns].where(df[object_columns].notna(), np.nan)
+        return df
+
+    df = pd.read_csv(csv_path, lineterminator='\n')
+    # the cache is only an optimization, so failing to write it (e.g. read-only input directory) is not fatal
+    try:
+        os.makedirs(os.path.join(dir, CSV_CACHE_DIR), exist_ok=True)
+        df.to_parquet(cache_path)
+    except (OSError, TypeError, ValueError):
+        # drop any partially written copy so it is not read on the next run
+        try:
+            os.remove(cache_path)
+        except OSError:
+            pass
+    return df
+
+
+def get_csvs_in_dir(dir: str, return_filenames: bool = False,
+                    sort: bool = True) -> Union[List[pd.DataFrame], Tuple[List[pd.DataFrame], List[str]]]:
+    filenames = get_csv_filenames(dir, sort=sort)
+    # pandas' CSV and Parquet readers release the GIL, so threads overlap reading and parsing across files
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_READ_THREADS, len(filenames)))) as executor:
+        files = list(executor.map(lambda filename: read_csv_cached(dir, filename), filenames))
     if return_filenames:
         return files, filenames
     return files
 
 
-def convert_str_to_datetime_maker(formt: str) -> Callable:
-    def convert(string):
-        if type(string) is float:
-            return string
-        else:
-            return datetime.strptime(string, formt)
-    return convert
-
-
 def get_license_df(path: str) -> Union[pd.DataFrame, None]:
     license_df = pd.concat(get_csvs_in_dir(path))[LICENSE_FIELDS]
     assert 'License Number' in license_df.columns, 'License files must include license number field'
 
     license_df = clean_column_names(license_df)
     license_df = license_df.rename({'license_number': 'license', 'license_type': 'license_business_type'}, axis=1)
-    for column in license_df.columns:
-        if type(license_df[column].iloc[0]) is str:
-            license_df[column] = license_df[column].str.lower()
+    string_columns = license_df.select_dtypes(include='object').columns
+    license_df[string_columns] = license_df[string_columns].apply(lambda column: column.str.lower())
 
     if 'issue_date' in license_df.columns:
-        license_df = license_df[license_df['issue_date'].str.contains('/')]
+        license_df = license_df[license_df['issue_date'].str.contains('/', regex=False, na=False)]
     return license_df
 
 
@@ -233,20 +300,48 @@ def get_index_of_date(date: str, filenames: List[str]) -> int:
         idx += 1
 
 
-def append_tag_conditional(lst: List[int], condition: int) -> None:
-    if condition:
-        lst.append(1)
-    else:
-        lst.append(0)
+def get_slug_dtype(files: List[pd.DataFrame]) -> CategoricalDtype:
+    """
+    Categorical dtype over every slug in the given files. Sharing it across all panels lets storefronts be matched,
+    merged and grouped by integer code instead of by string. Categories are sorted and marked ordered so that grouping
+    by slug keeps the alphabetical order of grouping the plain strings (an observed=True groupby on an unordered
+    categorical returns groups in order of appearance instead).
+    """
+    slugs = np.sort(pd.unique(np.concatenate([file['slug'].to_numpy() for file in files])))
+    return CategoricalDtype(categories=slugs, ordered=True)
+
+
+def get_slug_codes(files: List[pd.DataFrame]) -> Tuple[List[np.ndarray], int]:
+    """
+    Returns each file's slug codes under the shared slug dtype (see get_slug_dtype) and the number of distinct slugs
+    """
+    slug_count = len(files[0]['slug'].cat.categories)
+    return [file['slug'].cat.codes.to_numpy() for file in files], slug_count
 
 
-def get_slugs_up_to_i_array(files: List[pd.DataFrame]) -> List[Set[str]]:
-    slugs_up_to_i = [set(files[0]['slug'])]
-    for i in range(1, len(files)):
-        slugs_up_to_i.append(
-            set(files[i]['slug']).union(slugs_up_to_i[i - 1])
-        )
-    return slugs_up_to_i
+def get_slug_presence(slug_codes: List[np.ndarray], slug_count: int) -> np.ndarray:
+    """
+    Returns a (wave, slug code) boolean matrix recording which storefronts are present in each wave
+    """
+    presence = np.zeros((len(slug_codes), slug_count), dtype=bool)
+    for i, codes in enumerate(slug_codes):
+        presence[i, codes] = True
+    return presence
+
+
+@njit(cache=True)
+def get_presence_after_i(presence: np.ndarray) -> np.ndarray:
+    """
+    Given a (wave, slug code) presence matrix, marks for each wave the slugs present in any later wave
+    """
+    wave_count, slug_count = presence.shape
+    presence_after_i = np.empty_like(presence)
+    seen = np.zeros(slug_count, dtype=np.bool_)
+    for i in range(wave_count - 1, -1, -1):
+        presence_after_i[i] = seen
+        for k in range(slug_count):
+            seen[k] = seen[k] | presence[i, k]
+    return presence_after_i
 
 
 def clean_column_names(file: pd.DataFrame) -> pd.DataFrame:
@@ -257,9 +352,4 @@ def clean_column_names(file: pd.DataFrame) -> pd.DataFrame:
 
 
 def get_column_difference(df1: pd.DataFrame, df2: pd.DataFrame) -> List[str]:
-    diff = []
-    df2_set = set(df2)
-    for column in df1:
-        if column not in df2_set:
-            diff.append(column)
-    return diff
+    return df1.columns.difference(df2.columns, sort=False).tolist()